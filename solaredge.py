@@ -1,771 +1,696 @@
 #!/usr/bin/env python3
 import argparse
-import datetime
+import array
+import asyncio
+import collections
+import functools
 import logging
+import math
+import socket
+import struct
+import time
 
-from pymodbus.client import ModbusTcpClient
-from pymodbus.client.mixin import ModbusClientMixin
-import asyncio
-from influxdb_client import InfluxDBClient, Point
-from influxdb_client.client.write_api import SYNCHRONOUS
-from prometheus_client import Gauge
-from prometheus_client import start_http_server
-from prometheus_client import Counter, Histogram
-
-datapoint = {
-    'measurement': 'SolarEdge',
-    'tags': {},
-    'fields': {}
-}
-reg_block = {}
+from pymodbus.client import AsyncModbusTcpClient
+from influxdb_client import WritePrecision
+from influxdb_client.client.influxdb_client_async import InfluxDBClientAsync
+from prometheus_client import Counter, Gauge, Histogram, start_http_server
+
+# Per-field Gauges, keyed by metric name
 promInv = {}
 promMeter = {}
+# Bound Gauge.set methods per device, keyed by (objtype, metriclabel, meternum, legacysupport, labeled)
+# and then by field name
+promSetters = {}
 logger = logging.getLogger('solaredge')
 
 # Prometheus counters/histogram for Modbus I/O health
 modbus_send_errors = Counter('modbus_send_errors_total', 'Modbus send() failures', ['section'])
 modbus_recv_errors = Counter('modbus_recv_errors_total', 'Modbus recv() failures', ['section'])
 modbus_timeouts    = Counter('modbus_timeouts_total', 'Modbus timeouts', ['section'])
-modbus_req_latency_sec = Histogram('modbus_request_latency_seconds', 'ReadHoldingRegisters latency', ['section'])
+# Buckets sized for Modbus TCP round trips (a few ms up to the 10 s client timeout)
+modbus_req_latency_sec = Histogram('modbus_request_latency_seconds', 'ReadHoldingRegisters latency', ['section'],
+                                   buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 10.0))
+
+# Inverter model block (40069, 50 registers): (field, offset, type, scale factor offset).
+# Fields without a scale factor offset are published unscaled.
+_INV_FIELDS = (
+    ('SunSpec_DID', 0, 'u16', None),
+    ('SunSpec_Length', 1, 'u16', None),
+    ('AC_Current', 2, 'u16', 6),
+    ('AC_CurrentA', 3, 'u16', 6),
+    ('AC_CurrentB', 4, 'u16', 6),
+    ('AC_CurrentC', 5, 'u16', 6),
+    ('AC_VoltageAB', 7, 'u16', 13),
+    ('AC_VoltageBC', 8, 'u16', 13),
+    ('AC_VoltageCA', 9, 'u16', 13),
+    ('AC_VoltageAN', 10, 'u16', 13),
+    ('AC_VoltageBN', 11, 'u16', 13),
+    ('AC_VoltageCN', 12, 'u16', 13),
+    ('AC_Power', 14, 'i16', 15),
+    ('AC_Frequency', 16, 'u16', 17),
+    ('AC_VA', 18, 'i16', 19),
+    ('AC_VAR', 20, 'i16', 21),
+    ('AC_PF', 22, 'i16', 23),
+    ('AC_Energy_WH', 24, 'u32', 26),
+    ('DC_Current', 27, 'u16', 28),
+    ('DC_Voltage', 29, 'u16', 30),
+    ('DC_Power', 31, 'i16', 32),
+    ('Temp_Sink', 34, 'i16', 37),
+    ('Status', 38, 'u16', None),
+    ('Status_Vendor', 39, 'u16', None),
+)
+
+# Meter model block (105 registers from 40188/40362/40537), same layout as _INV_FIELDS
+_METER_FIELDS = (
+    ('M_SunSpec_DID', 0, 'u16', None),
+    ('M_SunSpec_Length', 1, 'u16', None),
+    ('M_AC_Current', 2, 'i16', 6),
+    ('M_AC_CurrentA', 3, 'i16', 6),
+    ('M_AC_CurrentB', 4, 'i16', 6),
+    ('M_AC_CurrentC', 5, 'i16', 6),
+    ('M_AC_VoltageLN', 7, 'i16', 15),
+    ('M_AC_VoltageAN', 8, 'i16', 15),
+    ('M_AC_VoltageBN', 9, 'i16', 15),
+    ('M_AC_VoltageCN', 10, 'i16', 15),
+    ('M_AC_VoltageLL', 11, 'i16', 15),
+    ('M_AC_VoltageAB', 12, 'i16', 15),
+    ('M_AC_VoltageBC', 13, 'i16', 15),
+    ('M_AC_VoltageCA', 14, 'i16', 15),
+    ('M_AC_Frequency', 16, 'i16', 17),
+    ('M_AC_Power', 18, 'i16', 22),
+    ('M_AC_Power_A', 19, 'i16', 22),
+    ('M_AC_Power_B', 20, 'i16', 22),
+    ('M_AC_Power_C', 21, 'i16', 22),
+    ('M_AC_VA', 23, 'i16', 27),
+    ('M_AC_VA_A', 24, 'i16', 27),
+    ('M_AC_VA_B', 25, 'i16', 27),
+    ('M_AC_VA_C', 26, 'i16', 27),
+    ('M_AC_VAR', 28, 'i16', 32),
+    ('M_AC_VAR_A', 29, 'i16', 32),
+    ('M_AC_VAR_B', 30, 'i16', 32),
+    ('M_AC_VAR_C', 31, 'i16', 32),
+    ('M_AC_PF', 33, 'i16', 37),
+    ('M_AC_PF_A', 34, 'i16', 37),
+    ('M_AC_PF_B', 35, 'i16', 37),
+    ('M_AC_PF_C', 36, 'i16', 37),
+    ('M_Exported', 38, 'u32', 54),
+    ('M_Exported_A', 40, 'u32', 54),
+    ('M_Exported_B', 42, 'u32', 54),
+    ('M_Exported_C', 44, 'u32', 54),
+    ('M_Imported', 46, 'u32', 54),
+    ('M_Imported_A', 48, 'u32', 54),
+    ('M_Imported_B', 50, 'u32', 54),
+    ('M_Imported_C', 52, 'u32', 54),
+    ('M_Exported_VA', 55, 'u32', 71),
+    ('M_Exported_VA_A', 57, 'u32', 71),
+    ('M_Exported_VA_B', 59, 'u32', 71),
+    ('M_Exported_VA_C', 61, 'u32', 71),
+    ('M_Imported_VA', 63, 'u32', 71),
+    ('M_Imported_VA_A', 65, 'u32', 71),
+    ('M_Imported_VA_B', 67, 'u32', 71),
+    ('M_Imported_VA_C', 69, 'u32', 71),
+)
+
+# Scale factors are already applied, but the fields are still published as 0.0
+# so existing InfluxDB schemas and dashboards keep them
+_INV_SF_FIELDS = (
+    'AC_Current_SF',
+    'AC_Voltage_SF',
+    'AC_Power_SF',
+    'AC_Frequency_SF',
+    'AC_VA_SF',
+    'AC_VAR_SF',
+    'AC_PF_SF',
+    'AC_Energy_WH_SF',
+    'DC_Current_SF',
+    'DC_Voltage_SF',
+    'DC_Power_SF',
+    'Temp_SF',
+)
+_METER_SF_FIELDS = (
+    'M_AC_Current_SF',
+    'M_AC_Voltage_SF',
+    'M_AC_Frequency_SF',
+    'M_AC_Power_SF',
+    'M_AC_VA_SF',
+    'M_AC_VAR_SF',
+    'M_AC_PF_SF',
+    'M_Energy_W_SF',
+)
+
+# Every field name of each table plus its scale factor placeholders, for decode_block()
+# to copy as its starting dict
+_INV_TEMPLATE = dict.fromkeys([name for name, *_ in _INV_FIELDS] + list(_INV_SF_FIELDS), 0.0)
+_METER_TEMPLATE = dict.fromkeys([name for name, *_ in _METER_FIELDS] + list(_METER_SF_FIELDS), 0.0)
+
+# Battery ratings at the end of the battery common block (offsets 66-75), read once at discovery
+_BATTERY_RATING_NAMES = (
+    'B_Rated_Energy',
+    'B_Max_Charge_Continues_Power',
+    'B_Max_Discharge_Continues_Power',
+    'B_Max_Charge_Peak_Power',
+    'B_Max_Discharge_Peak_Power',
+)
+
+# Battery measurements (30 registers from 57708/57964/58476): (field, offset, struct format).
+# Multi-register values are stored low word first, so they unpack as little-endian.
+_BATTERY_FIELDS = (
+    ('B_Average_Temperature', 0, 'f'),
+    ('B_Max_Temperature', 2, 'f'),
+    ('B_Instantaneous_Voltage', 4, 'f'),
+    ('B_Instantaneous_Current', 6, 'f'),
+    ('B_Instantaneous_Power', 8, 'f'),
+    ('B_Lifetime_Export_Energy_Counter', 10, 'Q'),
+    ('B_Lifetime_Import_Energy_Counter', 14, 'Q'),
+    ('B_Max_Energy', 18, 'f'),
+    ('B_Available_Energy', 20, 'f'),
+    ('B_State_of_Health', 22, 'f'),
+    ('B_State_of_Energy', 24, 'f'),
+    ('B_Status', 26, 'I'),
+    ('B_Status_Internal', 28, 'I'),
+)
+
+# String fields of a common block as (start, end) register slices, in SunSpecCommon order.
+# Batteries have no Options field and a 16-register Version.
+_COMMON_LAYOUT = ((0, 16), (16, 32), (32, 40), (40, 48), (48, 64))
+_BATTERY_COMMON_LAYOUT = ((0, 16), (16, 32), None, (32, 48), (48, 64))
+
+SunSpecCommon = collections.namedtuple('SunSpecCommon', 'manufacturer model option version serial device_address')
+
+# Discovery passes over the meter/battery common blocks before giving up on a device
+_DISCOVERY_ATTEMPTS = 6
+# Seconds between retries, while polling, of devices that never answered discovery
+_REDISCOVERY_INTERVAL = 300
+
+# (common block, polled block) start addresses for each meter and battery. The battery
+# poll skips the ratings (read at discovery) and the reserved registers that follow them.
+_METER_BASES = ((40123, 40188), (40297, 40362), (40471, 40537))
+_BATTERY_BASES = ((57600, 57708), (57856, 57964), (58368, 58476))
+
+# Precomputed 10**sf for the SunSpec scale factors seen in practice
+_SF_LUT = {i: 10.0 ** i for i in range(-20, 21)}
 
 ############################################################
 
-def publish_metrics(dictobj, objtype, metriclabel, meternum=0, legacysupport=False):
+def decode_block(reg_block, fields, template):
+    """Decode a SunSpec register block into a dict of scaled values using a field table.
+
+    The result starts as a copy of template, a dict already holding every field name, so it
+    is allocated at its final size. Values holding the SunSpec 'not implemented' pattern
+    (0xFFFF, 0xFFFFFFFF, or 0x8000 for signed fields) are published as 0.0.
+    """
+    # Copy the block into a packed array once and view it as signed 16-bit values
+    signed = memoryview(array.array('H', reg_block)).cast('B').cast('h')
+    values = template.copy()
+    for name, offset, kind, sf_offset in fields:
+        if kind == 'u32':
+            raw = (reg_block[offset] << 16) | reg_block[offset + 1]
+            if raw == 0xFFFFFFFF:
+                values[name] = 0.0
+                continue
+        elif kind == 'u16':
+            raw = reg_block[offset]
+            if raw == 0xFFFF:
+                values[name] = 0.0
+                continue
+        else:
+            raw = signed[offset]
+            if raw == -0x8000:
+                values[name] = 0.0
+                continue
+        if sf_offset is None:
+            values[name] = float(raw)
+        else:
+            sf = signed[sf_offset]
+            scale = _SF_LUT.get(sf)
+            if scale is None:
+                scale = 10.0 ** sf
+            # scale is always a float, so the product is too
+            values[name] = raw * scale
+    return values
+
+def decode_common(reg_block, layout=_COMMON_LAYOUT):
+    """Decode the strings and device address of a common (info) block into a SunSpecCommon."""
+    buf = struct.pack(f'>{len(reg_block)}H', *reg_block)
+    strings = []
+    for span in layout:
+        if span is None:
+            strings.append('')
+            continue
+        start, end = span
+        # Strings are NUL padded; keep everything before the first NUL
+        strings.append(buf[start * 2:end * 2].split(b'\x00', 1)[0].decode('utf-8', 'replace'))
+    return SunSpecCommon(*strings, reg_block[64])
+
+def _layout_struct(fields):
+    """Compile a (field, offset, struct format) table into one little-endian Struct, padding over gaps."""
+    fmt, pos = '<', 0
+    for name, offset, code in fields:
+        if offset > pos:
+            fmt += f'{(offset - pos) * 2}x'
+        fmt += code
+        pos = offset + struct.calcsize(code) // 2
+    return struct.Struct(fmt)
 
-    global datapoint
+_BATTERY_NAMES = tuple(name for name, offset, code in _BATTERY_FIELDS)
+_BATTERY_STRUCT = _layout_struct(_BATTERY_FIELDS)
+_BATTERY_RATINGS = struct.Struct('<5f')
 
-    if objtype == 'inverter' or objtype == 'battery':
-        global promInv
-        for key, value in dictobj.items():
-            # InfluxDB metrics
-            datapoint['fields'][key] = value
-            # Prometheus Metrics
-            if key in promInv:
-                promInv[key].set(value)
-            else:
-                promInv[key] = Gauge(key, key)
-                promInv[key].set(value)
+def decode_battery_ratings(reg_block):
+    """Decode the ratings from a battery common block, or return None if the slot is empty."""
+    ratings = dict(zip(_BATTERY_RATING_NAMES, _BATTERY_RATINGS.unpack(struct.pack('<10H', *reg_block[66:76]))))
+    rated = ratings['B_Rated_Energy']
+    # An empty slot reports a NaN or zero rated energy
+    if rated != rated or rated == 0.0:
+        return None
+    return ratings
 
+def decode_battery(reg_block, ratings):
+    """Decode a battery register block into a dict using the _BATTERY_FIELDS table, after the ratings."""
+    # Packing each register little-endian puts low-word-first values in little-endian byte order
+    buf = struct.pack(f'<{len(reg_block)}H', *reg_block)
+    values = dict(ratings)
+    values.update(zip(_BATTERY_NAMES, _BATTERY_STRUCT.unpack_from(buf)))
+    return values
+
+# Characters that must be backslash-escaped in a line-protocol measurement name
+_LP_ESCAPE_MEASUREMENT = str.maketrans({',': r'\,', ' ': r'\ ', '\n': r'\n', '\t': r'\t', '\r': r'\r'})
+
+def to_line_protocol(measurement, fields, time_ns):
+    """Format one datapoint as an InfluxDB line-protocol record, as the client would for the dict.
+
+    Field names come from the register tables and need no escaping. Ints are written as integer
+    fields; NaN and infinite floats are skipped because InfluxDB cannot store them.
+    """
+    parts = []
+    for name, value in sorted(fields.items()):
+        if isinstance(value, int):
+            parts.append(f'{name}={value}i')
+        elif math.isfinite(value):
+            text = str(value)
+            parts.append(f'{name}={text[:-2] if text.endswith(".0") else text}')
+    return f'{measurement.translate(_LP_ESCAPE_MEASUREMENT)} {",".join(parts)} {time_ns}'
+
+############################################################
+
+# Metric families used with --labeled_metrics: (name, description, label names)
+_LABELED_FAMILIES = {
+    'inverter': ('solaredge_inverter', 'SolarEdge inverter value', ['field']),
+    'meter': ('solaredge_meter', 'SolarEdge meter value', ['meter', 'label', 'field']),
+    'battery': ('solaredge_battery', 'SolarEdge battery value', ['battery', 'label', 'field']),
+}
+
+@functools.lru_cache(maxsize=None)
+def _labeled_family(objtype):
+    """Return the labeled Gauge family for a device type, registering it on first use."""
+    name, description, labelnames = _LABELED_FAMILIES[objtype]
+    return Gauge(name, description, labelnames)
+
+def _new_gauge(objtype, key, metriclabel, meternum, legacysupport, labeled):
+    """Look up or create the Gauge a device field is exported as."""
+    if labeled:
+        family = _labeled_family(objtype)
+        if objtype == 'inverter':
+            return family.labels(key)
+        return family.labels(str(meternum), metriclabel, key)
     if objtype == 'meter':
-        global promMeter
-        for key, value in dictobj.items():
-            # InfluxDB Metrics
-            datapoint['fields'][key] = value
-            # Prometheus Metrics
-            if meternum==1 and legacysupport==True:
-                if key in promMeter:
-                    promMeter[key].set(value)
-                else:
-                    promMeter[key] = Gauge(key, key + ' - ' + metriclabel)
-                    promMeter[key].set(value)
-            else:
-                metricname = key.replace('M_', 'M' + str(meternum) + '_')
-                if metricname in promMeter:
-                    promMeter[metricname].set(value)
-                else:
-                    promMeter[metricname] = Gauge(metricname, metricname + ' - ' + metriclabel)
-                    promMeter[metricname].set(value)
-                  
+        if meternum==1 and legacysupport==True:
+            metricname = key
+        else:
+            metricname = key.replace('M_', 'M' + str(meternum) + '_')
+        if metricname not in promMeter:
+            promMeter[metricname] = Gauge(metricname, metricname + ' - ' + metriclabel)
+        return promMeter[metricname]
+    if key not in promInv:
+        promInv[key] = Gauge(key, key)
+    return promInv[key]
+
+def publish_metrics(dictobj, objtype, metriclabel, meternum=0, legacysupport=False, labeled=False):
+
+    device = (objtype, metriclabel, meternum, legacysupport, labeled)
+    if device not in promSetters:
+        promSetters[device] = {}
+    setters = promSetters[device]
+    for key, value in dictobj.items():
+        setter = setters.get(key)
+        if setter is None:
+            setter = setters[key] = _new_gauge(objtype, key, metriclabel, meternum, legacysupport, labeled).set
+        setter(value)
+
+def _discovery_delay(attempt, max_delay=60):
+    """Seconds to wait before retrying device discovery: 1, 2, 4, ... capped at max_delay."""
+    return min(2 ** attempt, max_delay)
+
 ############################################################
 
+def _enable_keepalive(client, idle=30):
+    """Turn on TCP keepalive for the client's socket so gateways don't drop an idle session."""
+    transport = client.ctx.transport
+    sock = transport.get_extra_info('socket') if transport else None
+    if sock is None:
+        return
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    if hasattr(socket, 'TCP_KEEPIDLE'):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, idle)
+
+def _log_task_failure(task):
+    """Done callback for background tasks: nothing awaits them, so report an exception here."""
+    if not task.cancelled() and task.exception() is not None:
+        logger.error('Background task %s stopped', task.get_name(), exc_info=task.exception())
+
+async def _reconnect_supervisor(client, max_delay=60):
+    """Keep the Modbus connection to the inverter open, reconnecting with exponential backoff."""
+    delay = 1
+    while True:
+        if client.connected:
+            delay = 1
+            await asyncio.sleep(0.5)
+            continue
+        if await client.connect():
+            _enable_keepalive(client)
+            logger.info('Reconnected to inverter')
+            delay = 1
+        else:
+            logger.warning(f'Failed to reconnect to inverter, retrying in {delay}s')
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, max_delay)
+
+async def _influx_writer(queue, write_points, max_polls=120, max_delay=60):
+    """Write queued polls to InfluxDB in the background so a slow server doesn't delay polling.
 
-async def write_to_influx(dbhost, dbport, mbmeters, mbbatteries, period, dbname, legacysupport, uname, passw):
-    global client
-    global datapoint
-    global reg_block
-    global promInv
-    global promMeter
+    A failed write keeps its points: the writer backs off exponentially and then retries them
+    together with any polls queued meanwhile. Once more than max_polls polls are waiting the
+    oldest are dropped. A batch InfluxDB rejects as invalid (a 4xx other than 429) is dropped
+    straight away, since retrying it can't succeed.
+    """
+    pending = []
+    delay = 1
+    while True:
+        if not pending:
+            pending.append(await queue.get())
+        # Fold in any polls that queued up while the previous write was in flight
+        while not queue.empty():
+            pending.append(queue.get_nowait())
+        if len(pending) > max_polls:
+            logger.warning(f'Dropping the {len(pending) - max_polls} oldest unwritten poll(s)')
+            del pending[:-max_polls]
+        points = [point for poll in pending for point in poll]
+        try:
+            await write_points(points)
+            logger.info('Wrote %d datapoints to Influx.', len(points))
+            pending.clear()
+            delay = 1
+        except Exception as e:
+            status = getattr(e, 'status', None)
+            if isinstance(status, int) and 400 <= status < 500 and status != 429:
+                logger.error(f'InfluxDB rejected {len(points)} datapoints, dropping them: {e}')
+                pending.clear()
+                continue
+            logger.error(f'Failed to write data to InfluxDB, retrying {len(pending)} poll(s) in {delay}s: {e}')
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, max_delay)
+
+############################################################
 
-    def trunc_float(floatval):
-        return float('%.2f' % floatval)
 
+async def write_to_influx(inverter_ip, inverter_port, unitid, dbhost, dbport, mbmeters, mbbatteries, period, dbname, legacysupport, uname, passw, labeled=False):
     try:
         url = f"http://{dbhost}:{dbport}"
-        solar_client = InfluxDBClient(url=url, org="-", token=f"{uname}:{passw}")
-        write_api = solar_client.write_api(write_options=SYNCHRONOUS)
+        # The async client writes over aiohttp, so a slow InfluxDB doesn't stall the event loop
+        solar_client = InfluxDBClientAsync(url=url, org="-", token=f"{uname}:{passw}")
+        write_api = solar_client.write_api()
         bucket = dbname
 
-        def write_point(datapoint):
-            p = Point(datapoint["measurement"])
-            for k, v in datapoint.get("fields", {}).items():
-                p = p.field(k, v)
-            for k, v in datapoint.get("tags", {}).items():
-                p = p.tag(k, v)
-            if "time" in datapoint:
-                p = p.time(datapoint["time"])
-            write_api.write(bucket=bucket, record=p)
+        async def write_points(datapoints):
+            # One request for the whole poll rather than one per device; the records are
+            # already line protocol, so the client only has to encode them
+            await write_api.write(bucket=bucket, record=datapoints, write_precision=WritePrecision.NS)
     except Exception as e:
         logger.error(f'Error during connection to InfluxDb {dbhost}: {e}')
         return
     logger.info('Database opened and initialized')
+    # Polls waiting to be written; bounded so an unreachable InfluxDB can't grow it forever
+    write_queue = asyncio.Queue(maxsize=120)
+    writer_task = asyncio.create_task(_influx_writer(write_queue, write_points), name='influx-writer')
+    writer_task.add_done_callback(_log_task_failure)
+
+    # Connect to the solaredge inverter; the connection is kept open between polls
+    # and re-established in the background if it drops
+    client = AsyncModbusTcpClient(inverter_ip, port=inverter_port, timeout=10.0, reconnect_delay=0)
+    await client.connect()
+    _enable_keepalive(client)
+    reconnect_task = asyncio.create_task(_reconnect_supervisor(client), name='modbus-reconnect')
+    reconnect_task.add_done_callback(_log_task_failure)
+    # A single failed read doesn't mean the link is gone; only reconnect after this many in a row
+    max_failures = 3
+    failures = 0
 
     async def read_regs(addr: int, count: int, section: str):
-        """Read holding registers with reconnect and error handling."""
-            # Connect to the solaredge inverter
-        client = ModbusTcpClient(args.inverter_ip, port=args.inverter_port, timeout=10.0)
-        client.connect()
+        """Read holding registers, failing fast while the inverter is disconnected."""
+        nonlocal failures
+        if not client.connected:
+            logger.debug('Inverter not connected, skipping read of section %s', section)
+            return None
         try:
             # Measure request latency for this section
             with modbus_req_latency_sec.labels(section=section).time():
-                rb = client.read_holding_registers(addr, count=count, device_id=args.unitid)
+                rb = await client.read_holding_registers(addr, count=count, device_id=unitid)
 
             if rb.isError():
-                logger.error(f'Modbus error in section {section}: {rb}')
+                logger.error('Modbus error in section %s: %s', section, rb)
                 modbus_send_errors.labels(section=section).inc()
-                try:
-                    client.close()
-                except Exception:
-                    pass
-                await asyncio.sleep(3)
-                if not client.connect():
-                    logger.warning(f'Failed to reconnect to inverter after Modbus error in {section}')
                 return None
-                
-            client.close()
+
+            failures = 0
             return rb.registers
 
         except Exception as e:
-            logger.error(f'Modbus I/O exception in section {section}: {e}')
+            logger.error('Modbus I/O exception in section %s: %s', section, e)
             modbus_recv_errors.labels(section=section).inc()
-            try:
-                client.close()
-            except Exception:
-                pass
-            await asyncio.sleep(3)
-            # Attempt reconnection
-            if not client.connect():
-                logger.warning(f'Failed to reconnect to inverter after exception in {section}')
+            failures += 1
+            if failures >= max_failures:
+                # Drop the connection; the reconnect supervisor will reopen it
+                logger.warning('%d consecutive Modbus failures, reconnecting to inverter', failures)
+                failures = 0
+                try:
+                    client.close()
+                except Exception:
+                    pass
             return None
 
-    # Read the common blocks on the Inverter
+    # Read the common blocks on the Inverter; nothing works without it, so keep retrying
+    attempt = 0
     while True:
-        reg_block = {}
         reg_block = await read_regs(40004, 65, "inv_info")
         if reg_block:
-            InvManufacturer = ModbusClientMixin.convert_from_registers(reg_block[0:16], ModbusClientMixin.DATATYPE.STRING, word_order="big")
-            InvModel = ModbusClientMixin.convert_from_registers(reg_block[16:32], ModbusClientMixin.DATATYPE.STRING, word_order="big")
-            Invfoo = ModbusClientMixin.convert_from_registers(reg_block[32:40], ModbusClientMixin.DATATYPE.STRING, word_order="big")
-            InvVersion = ModbusClientMixin.convert_from_registers(reg_block[40:48], ModbusClientMixin.DATATYPE.STRING, word_order="big")
-            InvSerialNumber = ModbusClientMixin.convert_from_registers(reg_block[48:64], ModbusClientMixin.DATATYPE.STRING, word_order="big")
-            InvDeviceAddress = ModbusClientMixin.convert_from_registers([reg_block[64]], ModbusClientMixin.DATATYPE.UINT16, word_order="big")
+            inv = decode_common(reg_block)
 
             print('*' * 60)
             print('* Inverter Info')
             print('*' * 60)
-            print(' Manufacturer: ' + InvManufacturer)
-            print(' Model: ' + InvModel)
-            print(' Version: ' + InvVersion)
-            print(' Serial Number: ' + InvSerialNumber)
-            print(' ModBus ID: ' + str(InvDeviceAddress))
+            print(' Manufacturer: ' + inv.manufacturer)
+            print(' Model: ' + inv.model)
+            print(' Version: ' + inv.version)
+            print(' Serial Number: ' + inv.serial)
+            print(' ModBus ID: ' + str(inv.device_address))
             break
+        delay = _discovery_delay(attempt)
+        logger.warning(f'Inverter info not available, retrying in {delay}s')
+        await asyncio.sleep(delay)
+        attempt += 1
+
+    # Label for each meter; None until the meter answers discovery
+    dictMeterLabel = [None] * mbmeters
+    # Label for each battery; None until the battery answers discovery
+    dictBattery = [None] * mbbatteries
+    # Ratings for each attached battery; None for empty slots and batteries that never answered
+    dictBatteryRatings = [None] * mbbatteries
+
+    async def discover_meter(x):
+        """Read meter x's common block and print its info; return False if it didn't answer."""
+        reg_block = await read_regs(_METER_BASES[x-1][0], 65, f"meter_info_{x}")
+        if not reg_block:
+            return False
+        meter = decode_common(reg_block)
+        dictMeterLabel[x-1] = meter.manufacturer + '(' + meter.serial + ')'
+        print('*' * 60)
+        print('* Meter ' + str(x) + ' Info')
+        print('*' * 60)
+        print(' Manufacturer: ' + meter.manufacturer)
+        print(' Model: ' + meter.model)
+        print(' Mode: ' + meter.option)
+        print(' Version: ' + meter.version)
+        print(' Serial Number: ' + meter.serial)
+        print(' ModBus ID: ' + str(meter.device_address))
+        if x==mbmeters:
+            print('*' * 60)
+        return True
+
+    async def discover_battery(x):
+        """Read battery x's common block and ratings and print its info; return False if it didn't answer."""
+        reg_block = await read_regs(_BATTERY_BASES[x-1][0], 76, f"battery_info_{x}")
+        if not reg_block:
+            return False
+        batt = decode_common(reg_block, _BATTERY_COMMON_LAYOUT)
+        # skip reg_block[65] (2 bytes); the ratings are float32, low word first
+        ratings = decode_battery_ratings(reg_block)
+        if ratings is None:
+            logger.warning(f'Battery {x} reports no battery attached; skipping it')
+        dictBatteryRatings[x-1] = ratings
+        dictBattery[x-1] = batt.manufacturer + '(' + batt.serial + ')'
+        print('*' * 60)
+        print('* Battery ' + str(x) + ' Info')
+        print('*' * 60)
+        print(' Manufacturer: ' + batt.manufacturer)
+        print(' Model: ' + batt.model)
+        print(' Version: ' + batt.version)
+        print(' Serial Number: ' + batt.serial)
+        print(' ModBus ID: ' + str(batt.device_address))
+        if ratings is None:
+            print(' No battery attached')
         else:
-            continue
+            print(' Rated Energy: ' + str(ratings['B_Rated_Energy']))
+            print(' Max Charge Power: ' + str(ratings['B_Max_Charge_Continues_Power']))
+            print(' Max Discharge Power: ' + str(ratings['B_Max_Discharge_Continues_Power']))
+            print(' Max Charge Peak Power: ' + str(ratings['B_Max_Charge_Peak_Power']))
+            print(' Max Discharge Peak Power: ' + str(ratings['B_Max_Discharge_Peak_Power']))
+        if x==mbbatteries:
+            print('*' * 60)
+        return True
 
     # Read the common blocks on the meter/s (if present)
-    connflag = False
-    if mbmeters >= 1:
-        while True:
-            dictMeterLabel = []
-            for x in range(1, mbmeters+1):
-                reg_block = {}
-                if x==1:
-                    reg_block = await read_regs(40123, 65, f"meter_info_{x}")
-                if x==2:
-                    reg_block = await read_regs(40297, 65, f"meter_info_{x}")
-                if x==3:
-                    reg_block = await read_regs(40471, 65, f"meter_info_{x}")
-                if reg_block:
-                    MManufacturer = ModbusClientMixin.convert_from_registers(reg_block[0:16], ModbusClientMixin.DATATYPE.STRING, word_order="big")
-                    MModel = ModbusClientMixin.convert_from_registers(reg_block[16:32], ModbusClientMixin.DATATYPE.STRING, word_order="big")
-                    MOption = ModbusClientMixin.convert_from_registers(reg_block[32:40], ModbusClientMixin.DATATYPE.STRING, word_order="big")
-                    MVersion = ModbusClientMixin.convert_from_registers(reg_block[40:48], ModbusClientMixin.DATATYPE.STRING, word_order="big")
-                    MSerialNumber = ModbusClientMixin.convert_from_registers(reg_block[48:64], ModbusClientMixin.DATATYPE.STRING, word_order="big")
-                    MDeviceAddress = ModbusClientMixin.convert_from_registers([reg_block[64]], ModbusClientMixin.DATATYPE.UINT16, word_order="big")
-                    fooLabel = MManufacturer.split('\x00')[0] + '(' + MSerialNumber.split('\x00')[0] + ')'
-                    dictMeterLabel.append(fooLabel)
-                    print('*' * 60)
-                    print('* Meter ' + str(x) + ' Info')
-                    print('*' * 60)
-                    print(' Manufacturer: ' + MManufacturer)
-                    print(' Model: ' + MModel)
-                    print(' Mode: ' + MOption)
-                    print(' Version: ' + MVersion)
-                    print(' Serial Number: ' + MSerialNumber)
-                    print(' ModBus ID: ' + str(MDeviceAddress))
-                    if x==mbmeters:
-                        print('*' * 60)
-                    connflag = True
-                else:
-                    continue
-            if connflag:
-                break
+    for attempt in range(_DISCOVERY_ATTEMPTS):
+        for x in range(1, mbmeters + 1):
+            if dictMeterLabel[x-1] is None:
+                await discover_meter(x)
+        missing = dictMeterLabel.count(None)
+        if not missing:
+            break
+        if attempt + 1 < _DISCOVERY_ATTEMPTS:
+            delay = _discovery_delay(attempt)
+            logger.warning(f'{missing} meter(s) did not answer, retrying in {delay}s')
+            await asyncio.sleep(delay)
+    else:
+        logger.error(f'{dictMeterLabel.count(None)} meter(s) did not answer after {_DISCOVERY_ATTEMPTS} attempts; '
+                     f'retrying every {_REDISCOVERY_INTERVAL}s while polling')
 
     # Read the common blocks on the battery/s (if present)
-    battflag = False
-    if mbbatteries >= 1:
-        while True:
-            dictBattery = []
-            for x in range(1, mbbatteries+1):
-                reg_block = {}
-                if x==1:
-                    reg_block = await read_regs(57600, 76, f"battery_info_{x}")
-                if x==2:
-                    reg_block = await read_regs(57856, 76, f"battery_info_{x}")
-                if x==3:
-                    reg_block = await read_regs(58368, 76, f"battery_info_{x}")
-                if reg_block:
-                    BManufacturer = ModbusClientMixin.convert_from_registers(reg_block[0:16], ModbusClientMixin.DATATYPE.STRING, word_order="big")
-                    BModel = ModbusClientMixin.convert_from_registers(reg_block[16:32], ModbusClientMixin.DATATYPE.STRING, word_order="big")
-                    BVersion = ModbusClientMixin.convert_from_registers(reg_block[32:48], ModbusClientMixin.DATATYPE.STRING, word_order="big")
-                    BSerialNumber = ModbusClientMixin.convert_from_registers(reg_block[48:64], ModbusClientMixin.DATATYPE.STRING, word_order="big")
-                    BDeviceAddress = ModbusClientMixin.convert_from_registers([reg_block[64]], ModbusClientMixin.DATATYPE.UINT16, word_order="big")
-                    # skip reg_block[65] (2 bytes)
-                    BRatedEnergy = ModbusClientMixin.convert_from_registers(reg_block[66:68], ModbusClientMixin.DATATYPE.FLOAT32, word_order="little")
-                    BMaxChargePower = ModbusClientMixin.convert_from_registers(reg_block[68:70], ModbusClientMixin.DATATYPE.FLOAT32, word_order="little")
-                    BMaxDischargePower = ModbusClientMixin.convert_from_registers(reg_block[70:72], ModbusClientMixin.DATATYPE.FLOAT32, word_order="little")
-                    BMaxChargePeakPower = ModbusClientMixin.convert_from_registers(reg_block[72:74], ModbusClientMixin.DATATYPE.FLOAT32, word_order="little")
-                    BMaxDischargePeakPower = ModbusClientMixin.convert_from_registers(reg_block[74:76], ModbusClientMixin.DATATYPE.FLOAT32, word_order="little")
-                    fooLabel = BManufacturer.split('\x00')[0] + '(' + BSerialNumber.split('\x00')[0] + ')'
-                    dictBattery.append(fooLabel)
-                    print('*' * 60)
-                    print('* Battery ' + str(x) + ' Info')
-                    print('*' * 60)
-                    print(' Manufacturer: ' + BManufacturer)
-                    print(' Model: ' + BModel)
-                    print(' Version: ' + BVersion)
-                    print(' Serial Number: ' + BSerialNumber)
-                    print(' ModBus ID: ' + str(BDeviceAddress))
-                    print(' Rated Energy: ' + str(BRatedEnergy))
-                    print(' Max Charge Power: ' + str(BMaxChargePower))
-                    print(' Max Discharge Power: ' + str(BMaxDischargePower))
-                    print(' Max Charge Peak Power: ' + str(BMaxChargePeakPower))
-                    print(' Max Discharge Peak Power: ' + str(BMaxDischargePeakPower))
-                    if x==mbbatteries:
-                        print('*' * 60)
-                    connflag = True
-                else:
-                    continue
-            if connflag:
-                break
+    for attempt in range(_DISCOVERY_ATTEMPTS):
+        for x in range(1, mbbatteries + 1):
+            if dictBattery[x-1] is None:
+                await discover_battery(x)
+        missing = dictBattery.count(None)
+        if not missing:
+            break
+        if attempt + 1 < _DISCOVERY_ATTEMPTS:
+            delay = _discovery_delay(attempt)
+            logger.warning(f'{missing} battery(s) did not answer, retrying in {delay}s')
+            await asyncio.sleep(delay)
+    else:
+        logger.error(f'{dictBattery.count(None)} battery(s) did not answer after {_DISCOVERY_ATTEMPTS} attempts; '
+                     f'retrying every {_REDISCOVERY_INTERVAL}s while polling')
+
+    def poll_plan():
+        """(number, address) of the meters and batteries to read on every poll: those discovery found,
+        leaving out battery slots that reported no battery attached."""
+        meters = [(x, addr) for x, (_, addr) in enumerate(_METER_BASES[:mbmeters], 1)
+                  if dictMeterLabel[x-1] is not None]
+        batteries = [(x, addr) for x, (_, addr) in enumerate(_BATTERY_BASES[:mbbatteries], 1)
+                     if dictBatteryRatings[x-1] is not None]
+        return meters, batteries
+
+    poll_meters, poll_batteries = poll_plan()
+    next_rediscovery = time.monotonic() + _REDISCOVERY_INTERVAL
+
+    # Meter slots that report no meter attached, so the warning is only logged once
+    empty_meters = set()
 
     # Start the loop for collecting the metrics...
     while True:
         try:
-            reg_block = {}
-            dictInv = {}
+            # One request at a time over the open connection; pymodbus serialises them anyway
             reg_block = await read_regs(40069, 50, "inverter")
-            if reg_block:
-                # print(reg_block)
-                # reg_block[0] = Sun Spec DID
-                # reg_block[1] = Length of Model Block
-                # reg_block[2] = AC Total current value
-                # reg_block[3] = AC Phase A current value
-                # reg_block[4] = AC Phase B current value
-                # reg_block[5] = AC Phase C current value
-                # reg_block[6] = AC current scale factor
-                # reg_block[7] = AC Phase A to B voltage value
-                # reg_block[8] = AC Phase B to C voltage value
-                # reg_block[9] = AC Phase C to A voltage value
-                # reg_block[10] = AC Phase A to N voltage value
-                # reg_block[11] = AC Phase B to N voltage value
-                # reg_block[12] = AC Phase C to N voltage value
-                # reg_block[13] = AC voltage scale factor
-                # reg_block[14] = AC Power value
-                # reg_block[15] = AC Power scale factor
-                # reg_block[16] = AC Frequency value
-                # reg_block[17] = AC Frequency scale factor
-                # reg_block[18] = AC Apparent Power
-                # reg_block[19] = AC Apparent Power scale factor
-                # reg_block[20] = AC Reactive Power
-                # reg_block[21] = AC Reactive Power scale factor
-                # reg_block[22] = AC Power Factor
-                # reg_block[23] = AC Power Factor scale factor
-                # reg_block[24] = AC Lifetime Energy (HI bits)
-                # reg_block[25] = AC Lifetime Energy (LO bits)
-                # reg_block[26] = AC Lifetime Energy scale factor
-                # reg_block[27] = DC Current value
-                # reg_block[28] = DC Current scale factor
-                # reg_block[29] = DC Voltage value
-                # reg_block[30] = DC Voltage scale factor
-                # reg_block[31] = DC Power value
-                # reg_block[32] = DC Power scale factor
-                # reg_block[34] = Inverter temp
-                # reg_block[37] = Inverter temp scale factor
-                # reg_block[38] = Inverter Operating State
-                # reg_block[39] = Inverter Status Code
-                datapoint = {
-                    'measurement': 'Inverter',
-                    'fields': {}
-                }
-                logger.debug(f'inverter reg_block: {str(reg_block)}')
-
-                # SunSpec DID
-                fooVal = trunc_float(ModbusClientMixin.convert_from_registers([reg_block[0]], ModbusClientMixin.DATATYPE.UINT16, word_order="big"))
-                fooName = 'SunSpec_DID'
-                dictInv[fooName] = fooVal if fooVal < 65535 else 0.0
-                # SunSpec Length
-                fooVal = trunc_float(ModbusClientMixin.convert_from_registers([reg_block[1]], ModbusClientMixin.DATATYPE.UINT16, word_order="big"))
-                fooName = 'SunSpec_Length'
-                dictInv[fooName] = fooVal if fooVal < 65535 else 0.0
-                # AC Current scale factor
-                ac_current_sf = ModbusClientMixin.convert_from_registers([reg_block[6]], ModbusClientMixin.DATATYPE.INT16, word_order="big")
-                ac_current_sf = 10 ** ac_current_sf
-                # AC Current
-                fooVal = trunc_float(ModbusClientMixin.convert_from_registers([reg_block[2]], ModbusClientMixin.DATATYPE.UINT16, word_order="big"))
-                fooName = 'AC_Current'
-                dictInv[fooName] = fooVal * ac_current_sf if fooVal < 65535 else 0.0
-                fooVal = trunc_float(ModbusClientMixin.convert_from_registers([reg_block[3]], ModbusClientMixin.DATATYPE.UINT16, word_order="big"))
-                fooName = 'AC_CurrentA'
-                dictInv[fooName] = fooVal * ac_current_sf if fooVal < 65535 else 0.0
-                fooVal = trunc_float(ModbusClientMixin.convert_from_registers([reg_block[4]], ModbusClientMixin.DATATYPE.UINT16, word_order="big"))
-                fooName = 'AC_CurrentB'
-                dictInv[fooName] = fooVal * ac_current_sf if fooVal < 65535 else 0.0
-                fooVal = trunc_float(ModbusClientMixin.convert_from_registers([reg_block[5]], ModbusClientMixin.DATATYPE.UINT16, word_order="big"))
-                fooName = 'AC_CurrentC'
-                dictInv[fooName] = fooVal * ac_current_sf if fooVal < 65535 else 0.0
-                # AC Voltage scale factor
-                ac_voltage_sf = ModbusClientMixin.convert_from_registers([reg_block[13]], ModbusClientMixin.DATATYPE.INT16, word_order="big")
-                ac_voltage_sf = 10 ** ac_voltage_sf
-                # AC Voltage
-                fooVal = trunc_float(ModbusClientMixin.convert_from_registers([reg_block[7]], ModbusClientMixin.DATATYPE.UINT16, word_order="big"))
-                fooName = 'AC_VoltageAB'
-                dictInv[fooName] = fooVal * ac_voltage_sf if fooVal < 65535 else 0.0
-                fooVal = trunc_float(ModbusClientMixin.convert_from_registers([reg_block[8]], ModbusClientMixin.DATATYPE.UINT16, word_order="big"))
-                fooName = 'AC_VoltageBC'
-                dictInv[fooName] = fooVal * ac_voltage_sf if fooVal < 65535 else 0.0
-                fooVal = trunc_float(ModbusClientMixin.convert_from_registers([reg_block[9]], ModbusClientMixin.DATATYPE.UINT16, word_order="big"))
-                fooName = 'AC_VoltageCA'
-                dictInv[fooName] = fooVal * ac_voltage_sf if fooVal < 65535 else 0.0
-                fooVal = trunc_float(ModbusClientMixin.convert_from_registers([reg_block[10]], ModbusClientMixin.DATATYPE.UINT16, word_order="big"))
-                fooName = 'AC_VoltageAN'
-                dictInv[fooName] = fooVal * ac_voltage_sf if fooVal < 65535 else 0.0
-                fooVal = trunc_float(ModbusClientMixin.convert_from_registers([reg_block[11]], ModbusClientMixin.DATATYPE.UINT16, word_order="big"))
-                fooName = 'AC_VoltageBN'
-                dictInv[fooName] = fooVal * ac_voltage_sf if fooVal < 65535 else 0.0
-                fooVal = trunc_float(ModbusClientMixin.convert_from_registers([reg_block[12]], ModbusClientMixin.DATATYPE.UINT16, word_order="big"))
-                fooName = 'AC_VoltageCN'
-                dictInv[fooName] = fooVal * ac_voltage_sf if fooVal < 65535 else 0.0
-                # AC Power scale factor
-                ac_power_sf = ModbusClientMixin.convert_from_registers([reg_block[15]], ModbusClientMixin.DATATYPE.INT16, word_order="big")
-                ac_power_sf = 10 ** ac_power_sf
-                # AC Power
-                fooVal = trunc_float(ModbusClientMixin.convert_from_registers([reg_block[14]], ModbusClientMixin.DATATYPE.INT16, word_order="big"))
-                fooName = 'AC_Power'
-                dictInv[fooName] = fooVal * ac_power_sf if fooVal < 65535 else 0.0
-                # AC Frequency scale factor
-                ac_freq_sf = ModbusClientMixin.convert_from_registers([reg_block[17]], ModbusClientMixin.DATATYPE.INT16, word_order="big")
-                ac_freq_sf = 10 ** ac_freq_sf
-                # AC Frequency
-                fooVal = trunc_float(ModbusClientMixin.convert_from_registers([reg_block[16]], ModbusClientMixin.DATATYPE.UINT16, word_order="big"))
-                fooName = 'AC_Frequency'
-                dictInv[fooName] = fooVal * ac_freq_sf if fooVal < 65535 else 0.0
-                # AC Apparent Power scale factor
-                ac_va_sf = ModbusClientMixin.convert_from_registers([reg_block[19]], ModbusClientMixin.DATATYPE.INT16, word_order="big")
-                ac_va_sf = 10 ** ac_va_sf
-                # AC Apparent Power
-                fooVal = trunc_float(ModbusClientMixin.convert_from_registers([reg_block[18]], ModbusClientMixin.DATATYPE.INT16, word_order="big"))
-                fooName = 'AC_VA'
-                dictInv[fooName] = fooVal * ac_va_sf if fooVal < 65535 else 0.0
-                # AC Reactive Power scale factor
-                ac_var_sf = ModbusClientMixin.convert_from_registers([reg_block[21]], ModbusClientMixin.DATATYPE.INT16, word_order="big")
-                ac_var_sf = 10 ** ac_var_sf
-                # AC Reactive Power
-                fooVal = trunc_float(ModbusClientMixin.convert_from_registers([reg_block[20]], ModbusClientMixin.DATATYPE.INT16, word_order="big"))
-                fooName = 'AC_VAR'
-                dictInv[fooName] = fooVal * ac_var_sf if fooVal < 65535 else 0.0
-                # AC Power Factor scale factor
-                ac_pf_sf = ModbusClientMixin.convert_from_registers([reg_block[23]], ModbusClientMixin.DATATYPE.INT16, word_order="big")
-                ac_pf_sf = 10 ** ac_pf_sf
-                # AC Power Factor
-                fooVal = trunc_float(ModbusClientMixin.convert_from_registers([reg_block[22]], ModbusClientMixin.DATATYPE.INT16, word_order="big"))
-                fooName = 'AC_PF'
-                dictInv[fooName] = fooVal * ac_pf_sf if fooVal < 65535 else 0.0
-                # AC Lifetime Energy scale factor
-                ac_wh_sf = ModbusClientMixin.convert_from_registers([reg_block[26]], ModbusClientMixin.DATATYPE.UINT16, word_order="big")
-                ac_wh_sf = 10 ** ac_wh_sf
-                # AC Lifetime Energy Production
-                fooVal = trunc_float(ModbusClientMixin.convert_from_registers(reg_block[24:26], ModbusClientMixin.DATATYPE.UINT32, word_order="big"))
-                fooName = 'AC_Energy_WH'
-                dictInv[fooName] = fooVal * ac_wh_sf if fooVal < 4294967295 else 0.0
-                # DC Current scale factor
-                dc_current_sf = ModbusClientMixin.convert_from_registers([reg_block[28]], ModbusClientMixin.DATATYPE.INT16, word_order="big")
-                dc_current_sf = 10 ** dc_current_sf
-                # DC Current
-                fooVal = trunc_float(ModbusClientMixin.convert_from_registers([reg_block[27]], ModbusClientMixin.DATATYPE.UINT16, word_order="big"))
-                fooName = 'DC_Current'
-                dictInv[fooName] = fooVal * dc_current_sf if fooVal < 65535 else 0.0
-                # DC Voltage scale factor
-                dc_voltage_sf = ModbusClientMixin.convert_from_registers([reg_block[30]], ModbusClientMixin.DATATYPE.INT16, word_order="big")
-                dc_voltage_sf = 10 ** dc_voltage_sf
-                # DC Voltage
-                fooVal = trunc_float(ModbusClientMixin.convert_from_registers([reg_block[29]], ModbusClientMixin.DATATYPE.UINT16, word_order="big"))
-                fooName = 'DC_Voltage'
-                dictInv[fooName] = fooVal * dc_voltage_sf if fooVal < 65535 else 0.0
-                # DC Power scale factor
-                dc_power_sf = ModbusClientMixin.convert_from_registers([reg_block[32]], ModbusClientMixin.DATATYPE.INT16, word_order="big")
-                dc_power_sf = 10 ** dc_power_sf
-                # DC Power
-                fooVal = trunc_float(ModbusClientMixin.convert_from_registers([reg_block[31]], ModbusClientMixin.DATATYPE.INT16, word_order="big"))
-                fooName = 'DC_Power'
-                dictInv[fooName] = fooVal * dc_power_sf if fooVal < 65535 else 0.0
-                # Inverter temp scale factor
-                temp_sf = ModbusClientMixin.convert_from_registers([reg_block[37]], ModbusClientMixin.DATATYPE.INT16, word_order="big")
-                temp_sf = 10 ** temp_sf
-                # Inverter temp
-                fooVal = trunc_float(ModbusClientMixin.convert_from_registers([reg_block[34]], ModbusClientMixin.DATATYPE.INT16, word_order="big"))
-                fooName = 'Temp_Sink'
-                dictInv[fooName] = fooVal * temp_sf if fooVal < 65535 else 0.0
-                # Inverter Operating State
-                fooVal = trunc_float(ModbusClientMixin.convert_from_registers([reg_block[38]], ModbusClientMixin.DATATYPE.UINT16, word_order="big"))
-                fooName = 'Status'
-                dictInv[fooName] = fooVal if fooVal < 65535 else 0.0
-                # Inverter Status Code
-                fooVal = trunc_float(ModbusClientMixin.convert_from_registers([reg_block[39]], ModbusClientMixin.DATATYPE.UINT16, word_order="big"))
-                fooName = 'Status_Vendor'
-                dictInv[fooName] = fooVal if fooVal < 65535 else 0.0
-                # Adding the ScaleFactor elements
-                dictInv['AC_Current_SF'] = 0.0
-                dictInv['AC_Voltage_SF'] = 0.0
-                dictInv['AC_Power_SF'] = 0.0
-                dictInv['AC_Frequency_SF'] = 0.0
-                dictInv['AC_VA_SF'] = 0.0
-                dictInv['AC_VAR_SF'] = 0.0
-                dictInv['AC_PF_SF'] = 0.0
-                dictInv['AC_Energy_WH_SF'] = 0.0
-                dictInv['DC_Current_SF'] = 0.0
-                dictInv['DC_Voltage_SF'] = 0.0
-                dictInv['DC_Power_SF'] = 0.0
-                dictInv['Temp_SF'] = 0.0
-                logger.debug(f'Inverter')
-                for j, k in dictInv.items():
-                    logger.debug(f'  {j}: {k}')
-                publish_metrics(dictInv, 'inverter', '')
-                logger.debug('Done publishing inverter metrics...')
-                datapoint['time'] = str(datetime.datetime.now(datetime.UTC).isoformat())
-                logger.debug(f'Writing to Influx: {str(datapoint)}')
-                try:
-                    write_point(datapoint)
-                    logger.info('Wrote Inverter datapoint to Influx.')
-                except Exception as e:
-                    logger.error(f'Failed to write inverter data to InfluxDB: {e}')
-
-            else:
+            if not reg_block:
+                # Skip this poll; wait for the next interval rather than retrying straight away
+                await asyncio.sleep(period)
                 continue
-                    
-            for x in range(1, mbmeters+1):
+            meter_blocks = [(x, await read_regs(addr, 105, f"meter{x}")) for x, addr in poll_meters]
+            battery_blocks = [(x, await read_regs(addr, 30, f"battery{x}")) for x, addr in poll_batteries]
+            # All datapoints from this poll share one timestamp, in integer nanoseconds
+            now_ns = time.time_ns()
+            points = []
+
+            logger.debug('inverter reg_block: %s', reg_block)
+
+            dictInv = decode_block(reg_block, _INV_FIELDS, _INV_TEMPLATE)
+            datapoint = to_line_protocol('Inverter', dictInv, now_ns)
+            logger.debug('Inverter: %s', dictInv)
+            publish_metrics(dictInv, 'inverter', '', labeled=labeled)
+            logger.debug('Done publishing inverter metrics...')
+            logger.debug('Writing to Influx: %s', datapoint)
+            points.append(datapoint)
+
+            for x, reg_block in meter_blocks:
                 # Now loop through this for each meter that is attached.
-                logger.debug(f'Meter={str(x)}')
-                reg_block = {}
-                dictM = {}
-
-                # Start point is different for each meter
-                if x==1:
-                    reg_block = await read_regs(40188, 105, f"meter{x}")
-                if x==2:
-                    reg_block = await read_regs(40362, 105, f"meter{x}")
-                if x==3:
-                    reg_block = await read_regs(40537, 105, f"meter{x}")
-                # Guard for meter labels
-                if not dictMeterLabel or len(dictMeterLabel) < x:
-                    logger.error(f'Meter labels not initialized for meter {x}; skipping this read.')
-                    continue
+                logger.debug('Meter=%d', x)
                 if reg_block:
-                    logger.debug(f'meter reg_block: {str(reg_block)}')
-                
+                    logger.debug('meter reg_block: %s', reg_block)
+                    # An empty meter slot reports the not-implemented SunSpec DID
+                    if reg_block[0] == 0xFFFF:
+                        if x not in empty_meters:
+                            logger.warning('Meter %d reports no meter attached; skipping it', x)
+                            empty_meters.add(x)
+                        continue
+                    empty_meters.discard(x)
+
                     # Set the Label to use for the Meter Metrics for Prometheus
                     metriclabel = dictMeterLabel[x-1]
-                    # Clear data from inverter, otherwise we publish that again!
-                    datapoint = {
-                        'measurement': dictMeterLabel[x-1],
-                        'fields': {}
-                    }
-                    
-                    # SunSpec DID
-                    fooVal = trunc_float(ModbusClientMixin.convert_from_registers([reg_block[0]], ModbusClientMixin.DATATYPE.UINT16, word_order="big"))
-                    fooName = 'M_SunSpec_DID'
-                    dictM[fooName] = fooVal if fooVal < 65535 else 0.0
-                    # SunSpec Length
-                    fooVal = trunc_float(ModbusClientMixin.convert_from_registers([reg_block[1]], ModbusClientMixin.DATATYPE.UINT16, word_order="big"))
-                    fooName = 'M_SunSpec_Length'
-                    dictM[fooName] = fooVal if fooVal < 65535 else 0.0
-                    # AC Current scale factor
-                    m_ac_current_sf = ModbusClientMixin.convert_from_registers([reg_block[6]], ModbusClientMixin.DATATYPE.INT16, word_order="big")
-                    m_ac_current_sf = 10 ** m_ac_current_sf
-                    # AC Current
-                    fooVal = trunc_float(ModbusClientMixin.convert_from_registers([reg_block[2]], ModbusClientMixin.DATATYPE.INT16, word_order="big"))
-                    fooName = 'M_AC_Current'
-                    dictM[fooName] = fooVal * m_ac_current_sf if fooVal < 32768 else 0.0
-                    fooVal = trunc_float(ModbusClientMixin.convert_from_registers([reg_block[3]], ModbusClientMixin.DATATYPE.INT16, word_order="big"))
-                    fooName = 'M_AC_CurrentA'
-                    dictM[fooName] = fooVal * m_ac_current_sf if fooVal < 32768 else 0.0
-                    fooVal = trunc_float(ModbusClientMixin.convert_from_registers([reg_block[4]], ModbusClientMixin.DATATYPE.INT16, word_order="big"))
-                    fooName = 'M_AC_CurrentB'
-                    dictM[fooName] = fooVal * m_ac_current_sf if fooVal < 32768 else 0.0
-                    fooVal = trunc_float(ModbusClientMixin.convert_from_registers([reg_block[5]], ModbusClientMixin.DATATYPE.INT16, word_order="big"))
-                    fooName = 'M_AC_CurrentC'
-                    dictM[fooName] = fooVal * m_ac_current_sf if fooVal < 32768 else 0.0
-                    # AC Voltage scale factor
-                    m_ac_voltage_sf = ModbusClientMixin.convert_from_registers([reg_block[15]], ModbusClientMixin.DATATYPE.INT16, word_order="big")
-                    m_ac_voltage_sf = 10 ** m_ac_voltage_sf
-                    # AC Voltage
-                    fooVal = trunc_float(ModbusClientMixin.convert_from_registers([reg_block[7]], ModbusClientMixin.DATATYPE.INT16, word_order="big"))
-                    fooName = 'M_AC_VoltageLN'
-                    dictM[fooName] = fooVal * m_ac_voltage_sf if fooVal < 32768 else 0.0
-                    fooVal = trunc_float(ModbusClientMixin.convert_from_registers([reg_block[8]], ModbusClientMixin.DATATYPE.INT16, word_order="big"))
-                    fooName = 'M_AC_VoltageAN'
-                    dictM[fooName] = fooVal * m_ac_voltage_sf if fooVal < 32768 else 0.0
-                    fooVal = trunc_float(ModbusClientMixin.convert_from_registers([reg_block[9]], ModbusClientMixin.DATATYPE.INT16, word_order="big"))
-                    fooName = 'M_AC_VoltageBN'
-                    dictM[fooName] = fooVal * m_ac_voltage_sf if fooVal < 32768 else 0.0
-                    fooVal = trunc_float(ModbusClientMixin.convert_from_registers([reg_block[10]], ModbusClientMixin.DATATYPE.INT16, word_order="big"))
-                    fooName = 'M_AC_VoltageCN'
-                    dictM[fooName] = fooVal * m_ac_voltage_sf if fooVal < 32768 else 0.0
-                    fooVal = trunc_float(ModbusClientMixin.convert_from_registers([reg_block[11]], ModbusClientMixin.DATATYPE.INT16, word_order="big"))
-                    fooName = 'M_AC_VoltageLL'
-                    dictM[fooName] = fooVal * m_ac_voltage_sf if fooVal < 32768 else 0.0
-                    fooVal = trunc_float(ModbusClientMixin.convert_from_registers([reg_block[12]], ModbusClientMixin.DATATYPE.INT16, word_order="big"))
-                    fooName = 'M_AC_VoltageAB'
-                    dictM[fooName] = fooVal * m_ac_voltage_sf if fooVal < 32768 else 0.0
-                    fooVal = trunc_float(ModbusClientMixin.convert_from_registers([reg_block[13]], ModbusClientMixin.DATATYPE.INT16, word_order="big"))
-                    fooName = 'M_AC_VoltageBC'
-                    dictM[fooName] = fooVal * m_ac_voltage_sf if fooVal < 32768 else 0.0
-                    fooVal = trunc_float(ModbusClientMixin.convert_from_registers([reg_block[14]], ModbusClientMixin.DATATYPE.INT16, word_order="big"))
-                    fooName = 'M_AC_VoltageCA'
-                    dictM[fooName] = fooVal * m_ac_voltage_sf if fooVal < 32768 else 0.0
-                    # AC Frequency scale factor
-                    m_ac_freq_sf = ModbusClientMixin.convert_from_registers([reg_block[17]], ModbusClientMixin.DATATYPE.INT16, word_order="big")
-                    m_ac_freq_sf = 10 ** m_ac_freq_sf
-                    # AC Frequency
-                    fooVal = trunc_float(ModbusClientMixin.convert_from_registers([reg_block[16]], ModbusClientMixin.DATATYPE.INT16, word_order="big"))
-                    fooName = 'M_AC_Frequency'
-                    dictM[fooName] = fooVal * m_ac_freq_sf if fooVal < 32768 else 0.0
-                    # AC Real Power scale factor
-                    m_ac_power_sf = ModbusClientMixin.convert_from_registers([reg_block[22]], ModbusClientMixin.DATATYPE.INT16, word_order="big")
-                    m_ac_power_sf = 10 ** m_ac_power_sf
-                    # AC Real Power
-                    fooVal = trunc_float(ModbusClientMixin.convert_from_registers([reg_block[18]], ModbusClientMixin.DATATYPE.INT16, word_order="big"))
-                    fooName = 'M_AC_Power'
-                    dictM[fooName] = fooVal * m_ac_power_sf if fooVal < 32768 else 0.0
-                    fooVal = trunc_float(ModbusClientMixin.convert_from_registers([reg_block[19]], ModbusClientMixin.DATATYPE.INT16, word_order="big"))
-                    fooName = 'M_AC_Power_A'
-                    dictM[fooName] = fooVal * m_ac_power_sf if fooVal < 32768 else 0.0
-                    fooVal = trunc_float(ModbusClientMixin.convert_from_registers([reg_block[20]], ModbusClientMixin.DATATYPE.INT16, word_order="big"))
-                    fooName = 'M_AC_Power_B'
-                    dictM[fooName] = fooVal * m_ac_power_sf if fooVal < 32768 else 0.0
-                    fooVal = trunc_float(ModbusClientMixin.convert_from_registers([reg_block[21]], ModbusClientMixin.DATATYPE.INT16, word_order="big"))
-                    fooName = 'M_AC_Power_C'
-                    dictM[fooName] = fooVal * m_ac_power_sf if fooVal < 32768 else 0.0
-                    # AC Apparent Power scale factor
-                    m_ac_va_sf = ModbusClientMixin.convert_from_registers([reg_block[27]], ModbusClientMixin.DATATYPE.INT16, word_order="big")
-                    m_ac_va_sf = 10 ** m_ac_va_sf
-                    # AC Apparent Power
-                    fooVal = trunc_float(ModbusClientMixin.convert_from_registers([reg_block[23]], ModbusClientMixin.DATATYPE.INT16, word_order="big"))
-                    fooName = 'M_AC_VA'
-                    dictM[fooName] = fooVal * m_ac_va_sf if fooVal < 32768 else 0.0
-                    fooVal = trunc_float(ModbusClientMixin.convert_from_registers([reg_block[24]], ModbusClientMixin.DATATYPE.INT16, word_order="big"))
-                    fooName = 'M_AC_VA_A'
-                    dictM[fooName] = fooVal * m_ac_va_sf if fooVal < 32768 else 0.0
-                    fooVal = trunc_float(ModbusClientMixin.convert_from_registers([reg_block[25]], ModbusClientMixin.DATATYPE.INT16, word_order="big"))
-                    fooName = 'M_AC_VA_B'
-                    dictM[fooName] = fooVal * m_ac_va_sf if fooVal < 32768 else 0.0
-                    fooVal = trunc_float(ModbusClientMixin.convert_from_registers([reg_block[26]], ModbusClientMixin.DATATYPE.INT16, word_order="big"))
-                    fooName = 'M_AC_VA_C'
-                    dictM[fooName] = fooVal * m_ac_va_sf if fooVal < 32768 else 0.0
-                    # AC Reactive Power scale factor
-                    m_ac_var_sf = ModbusClientMixin.convert_from_registers([reg_block[32]], ModbusClientMixin.DATATYPE.INT16, word_order="big")
-                    m_ac_var_sf = 10 ** m_ac_var_sf
-                    # AC Reactive Power
-                    fooVal = trunc_float(ModbusClientMixin.convert_from_registers([reg_block[28]], ModbusClientMixin.DATATYPE.INT16, word_order="big"))
-                    fooName = 'M_AC_VAR'
-                    dictM[fooName] = fooVal * m_ac_var_sf if fooVal < 32768 else 0.0
-                    fooVal = trunc_float(ModbusClientMixin.convert_from_registers([reg_block[29]], ModbusClientMixin.DATATYPE.INT16, word_order="big"))
-                    fooName = 'M_AC_VAR_A'
-                    dictM[fooName] = fooVal * m_ac_var_sf if fooVal < 32768 else 0.0
-                    fooVal = trunc_float(ModbusClientMixin.convert_from_registers([reg_block[30]], ModbusClientMixin.DATATYPE.INT16, word_order="big"))
-                    fooName = 'M_AC_VAR_B'
-                    dictM[fooName] = fooVal * m_ac_var_sf if fooVal < 32768 else 0.0
-                    fooVal = trunc_float(ModbusClientMixin.convert_from_registers([reg_block[31]], ModbusClientMixin.DATATYPE.INT16, word_order="big"))
-                    fooName = 'M_AC_VAR_C'
-                    dictM[fooName] = fooVal * m_ac_var_sf if fooVal < 32768 else 0.0
-                    # AC Power Factor scale factor
-                    m_ac_pf_sf = ModbusClientMixin.convert_from_registers([reg_block[37]], ModbusClientMixin.DATATYPE.INT16, word_order="big")
-                    m_ac_pf_sf = 10 ** m_ac_pf_sf
-                    # AC Power Factor
-                    fooVal = trunc_float(ModbusClientMixin.convert_from_registers([reg_block[33]], ModbusClientMixin.DATATYPE.INT16, word_order="big"))
-                    fooName = 'M_AC_PF'
-                    dictM[fooName] = fooVal * m_ac_pf_sf if fooVal < 32768 else 0.0
-                    fooVal = trunc_float(ModbusClientMixin.convert_from_registers([reg_block[34]], ModbusClientMixin.DATATYPE.INT16, word_order="big"))
-                    fooName = 'M_AC_PF_A'
-                    dictM[fooName] = fooVal * m_ac_pf_sf if fooVal < 32768 else 0.0
-                    fooVal = trunc_float(ModbusClientMixin.convert_from_registers([reg_block[35]], ModbusClientMixin.DATATYPE.INT16, word_order="big"))
-                    fooName = 'M_AC_PF_B'
-                    dictM[fooName] = fooVal * m_ac_pf_sf if fooVal < 32768 else 0.0
-                    fooVal = trunc_float(ModbusClientMixin.convert_from_registers([reg_block[36]], ModbusClientMixin.DATATYPE.INT16, word_order="big"))
-                    fooName = 'M_AC_PF_C'
-                    dictM[fooName] = fooVal * m_ac_pf_sf if fooVal < 32768 else 0.0
-                    # Real Energy scale factor
-                    m_energy_sf = ModbusClientMixin.convert_from_registers([reg_block[54]], ModbusClientMixin.DATATYPE.INT16, word_order="big")
-                    m_energy_sf = 10 ** m_energy_sf
-                    # Accumulated AC Real Energy
-                    fooVal = trunc_float(ModbusClientMixin.convert_from_registers(reg_block[38:40], ModbusClientMixin.DATATYPE.UINT32, word_order="big"))
-                    fooName = 'M_Exported'
-                    dictM[fooName] = fooVal * m_energy_sf if fooVal < 4294967295 else 0.0
-                    fooVal = trunc_float(ModbusClientMixin.convert_from_registers(reg_block[40:42], ModbusClientMixin.DATATYPE.UINT32, word_order="big"))
-                    fooName = 'M_Exported_A'
-                    dictM[fooName] = fooVal * m_energy_sf if fooVal < 4294967295 else 0.0
-                    fooVal = trunc_float(ModbusClientMixin.convert_from_registers(reg_block[42:44], ModbusClientMixin.DATATYPE.UINT32, word_order="big"))
-                    fooName = 'M_Exported_B'
-                    dictM[fooName] = fooVal * m_energy_sf if fooVal < 4294967295 else 0.0
-                    fooVal = trunc_float(ModbusClientMixin.convert_from_registers(reg_block[44:46], ModbusClientMixin.DATATYPE.UINT32, word_order="big"))
-                    fooName = 'M_Exported_C'
-                    dictM[fooName] = fooVal * m_energy_sf if fooVal < 4294967295 else 0.0
-                    fooVal = trunc_float(ModbusClientMixin.convert_from_registers(reg_block[46:48], ModbusClientMixin.DATATYPE.UINT32, word_order="big"))
-                    fooName = 'M_Imported'
-                    dictM[fooName] = fooVal * m_energy_sf if fooVal < 4294967295 else 0.0
-                    fooVal = trunc_float(ModbusClientMixin.convert_from_registers(reg_block[48:50], ModbusClientMixin.DATATYPE.UINT32, word_order="big"))
-                    fooName = 'M_Imported_A'
-                    dictM[fooName] = fooVal * m_energy_sf if fooVal < 4294967295 else 0.0
-                    fooVal = trunc_float(ModbusClientMixin.convert_from_registers(reg_block[50:52], ModbusClientMixin.DATATYPE.UINT32, word_order="big"))
-                    fooName = 'M_Imported_B'
-                    dictM[fooName] = fooVal * m_energy_sf if fooVal < 4294967295 else 0.0
-                    fooVal = trunc_float(ModbusClientMixin.convert_from_registers(reg_block[52:54], ModbusClientMixin.DATATYPE.UINT32, word_order="big"))
-                    fooName = 'M_Imported_C'
-                    dictM[fooName] = fooVal * m_energy_sf if fooVal < 4294967295 else 0.0
-                    # Add the ScaleFactor elements
-                    dictM['M_AC_Current_SF'] = 0.0
-                    dictM['M_AC_Voltage_SF'] = 0.0
-                    dictM['M_AC_Frequency_SF'] = 0.0
-                    dictM['M_AC_Power_SF'] = 0.0
-                    dictM['M_AC_VA_SF'] = 0.0
-                    dictM['M_AC_VAR_SF'] = 0.0
-                    dictM['M_AC_PF_SF'] = 0.0
-                    dictM['M_Energy_W_SF'] = 0.0
-                    publish_metrics(dictM, 'meter', metriclabel, x, legacysupport)
-                    datapoint['time'] = str(datetime.datetime.now(datetime.UTC).isoformat())
-                    logger.debug(f'Meter: {metriclabel}')
-                    for j, k in dictM.items():
-                        logger.debug(f'  {j}: {k}')
-                    logger.debug(f'Writing to Influx: {str(datapoint)}')
-                    try:
-                        write_point(datapoint)
-                        logger.info(f'Wrote Meter {x} ({metriclabel}) datapoint to Influx.')
-                    except Exception as e:
-                        logger.error(f'Failed to write meter {x} ({metriclabel}) data to InfluxDB: {e}')
+
+                    dictM = decode_block(reg_block, _METER_FIELDS, _METER_TEMPLATE)
+                    datapoint = to_line_protocol(metriclabel, dictM, now_ns)
+                    publish_metrics(dictM, 'meter', metriclabel, x, legacysupport, labeled)
+                    logger.debug('Meter %s: %s', metriclabel, dictM)
+                    logger.debug('Writing to Influx: %s', datapoint)
+                    points.append(datapoint)
 
                 else:
                     continue
      
-            for x in range(1, mbbatteries+1):
+            for x, reg_block in battery_blocks:
                 # Now loop through this for each battery that is attached.
-                logger.debug(f'Battery={str(x)}')
-                reg_block = {}
-                dictB = {}
-
-                # Start point is different for each battery
-                if x==1:
-                    reg_block = await read_regs(57666, 72, f"battery{x}")
-                if x==2:
-                    reg_block = await read_regs(57922, 72, f"battery{x}")
-                if x==3:
-                    reg_block = await read_regs(58434, 72, f"battery{x}")
+                logger.debug('Battery=%d', x)
                 if reg_block:
-                    logger.debug(f'meter reg_block: {str(reg_block)}')
-                
+                    logger.debug('battery reg_block: %s', reg_block)
+
                     # Set the Label to use for the Battery Metrics for Prometheus
                     metriclabel = dictBattery[x-1]
-                    # Clear data from inverter, otherwise we publish that again!
-                    datapoint = {
-                        'measurement': dictBattery[x-1],
-                        'fields': {}
-                    }
-                    
-                    # Battery Rated Energy
-                    fooVal = ModbusClientMixin.convert_from_registers(reg_block[0:2], ModbusClientMixin.DATATYPE.FLOAT32, word_order="little")
-                    fooName = 'B_Rated_Energy'
-                    dictB[fooName] = fooVal
-                    # Battery Max Charge Continues Power
-                    fooVal = ModbusClientMixin.convert_from_registers(reg_block[2:4], ModbusClientMixin.DATATYPE.FLOAT32, word_order="little")
-                    fooName = 'B_Max_Charge_Continues_Power'
-                    dictB[fooName] = fooVal
-                    # Battery Max Discharge Continues Power
-                    fooVal = ModbusClientMixin.convert_from_registers(reg_block[4:6], ModbusClientMixin.DATATYPE.FLOAT32, word_order="little")
-                    fooName = 'B_Max_Discharge_Continues_Power'
-                    dictB[fooName] = fooVal
-                    # Battery Max Charge Peak Power
-                    fooVal = ModbusClientMixin.convert_from_registers(reg_block[6:8], ModbusClientMixin.DATATYPE.FLOAT32, word_order="little")
-                    fooName = 'B_Max_Charge_Peak_Power'
-                    dictB[fooName] = fooVal
-                    # Battery Max Discharge Peak Power
-                    fooVal = ModbusClientMixin.convert_from_registers(reg_block[8:10], ModbusClientMixin.DATATYPE.FLOAT32, word_order="little")
-                    fooName = 'B_Max_Discharge_Peak_Power'
-                    dictB[fooName] = fooVal
-                    # Battery Average Temperature
-                    fooVal = ModbusClientMixin.convert_from_registers(reg_block[42:44], ModbusClientMixin.DATATYPE.FLOAT32, word_order="little")
-                    fooName = 'B_Average_Temperature'
-                    dictB[fooName] = fooVal
-                    # Battery Max Temperature
-                    fooVal = ModbusClientMixin.convert_from_registers(reg_block[44:46], ModbusClientMixin.DATATYPE.FLOAT32, word_order="little")
-                    fooName = 'B_Max_Temperature'
-                    dictB[fooName] = fooVal
-                    # Battery Instantaneous Voltage
-                    fooVal = ModbusClientMixin.convert_from_registers(reg_block[46:48], ModbusClientMixin.DATATYPE.FLOAT32, word_order="little")
-                    fooName = 'B_Instantaneous_Voltage'
-                    dictB[fooName] = fooVal
-                    # Battery Instantaneous Current
-                    fooVal = ModbusClientMixin.convert_from_registers(reg_block[48:50], ModbusClientMixin.DATATYPE.FLOAT32, word_order="little")
-                    fooName = 'B_Instantaneous_Current'
-                    dictB[fooName] = fooVal
-                    # Battery Instantaneous Power
-                    fooVal = ModbusClientMixin.convert_from_registers(reg_block[50:52], ModbusClientMixin.DATATYPE.FLOAT32, word_order="little")
-                    fooName = 'B_Instantaneous_Power'
-                    dictB[fooName] = fooVal
-                    # Battery Lifetime Export Energy Counter
-                    fooVal = ModbusClientMixin.convert_from_registers(reg_block[52:56], ModbusClientMixin.DATATYPE.UINT64, word_order="little")
-                    fooName = 'B_Lifetime_Export_Energy_Counter'
-                    dictB[fooName] = fooVal
-                    # Battery Lifetime Import Energy Counter
-                    fooVal = ModbusClientMixin.convert_from_registers(reg_block[56:60], ModbusClientMixin.DATATYPE.UINT64, word_order="little")
-                    fooName = 'B_Lifetime_Import_Energy_Counter'
-                    dictB[fooName] = fooVal
-                    # Battery Max Energy
-                    fooVal = ModbusClientMixin.convert_from_registers(reg_block[60:62], ModbusClientMixin.DATATYPE.FLOAT32, word_order="little")
-                    fooName = 'B_Max_Energy'
-                    dictB[fooName] = fooVal
-                    # Battery Available Energy
-                    fooVal = ModbusClientMixin.convert_from_registers(reg_block[62:64], ModbusClientMixin.DATATYPE.FLOAT32, word_order="little")
-                    fooName = 'B_Available_Energy'
-                    dictB[fooName] = fooVal
-                    # Battery State of Health
-                    fooVal = ModbusClientMixin.convert_from_registers(reg_block[64:66], ModbusClientMixin.DATATYPE.FLOAT32, word_order="little")
-                    fooName = 'B_State_of_Health'
-                    dictB[fooName] = fooVal
-                    # Battery State of Energy
-                    fooVal = ModbusClientMixin.convert_from_registers(reg_block[66:68], ModbusClientMixin.DATATYPE.FLOAT32, word_order="little")
-                    fooName = 'B_State_of_Energy'
-                    dictB[fooName] = fooVal
-                    # Battery Status
-                    fooVal = ModbusClientMixin.convert_from_registers(reg_block[68:70], ModbusClientMixin.DATATYPE.UINT32, word_order="little")
-                    fooName = 'B_Status'
-                    dictB[fooName] = fooVal
-                    # Battery Status Internal
-                    fooVal = ModbusClientMixin.convert_from_registers(reg_block[70:72], ModbusClientMixin.DATATYPE.UINT32, word_order="little")
-                    fooName = 'B_Status_Internal'
-                    dictB[fooName] = fooVal
-                    publish_metrics(dictB, 'battery', metriclabel, x, legacysupport)
-                    datapoint['time'] = str(datetime.datetime.now(datetime.UTC).isoformat())
-                    logger.debug(f'Battery: {metriclabel}')
-                    for j, k in dictB.items():
-                        logger.debug(f'  {j}: {k}')
-                    logger.debug(f'Writing to Influx: {str(datapoint)}')
-                    try:
-                        write_point(datapoint)
-                        logger.info(f'Wrote Battery {x} ({metriclabel}) datapoint to Influx.')
-                    except Exception as e:
-                        logger.error(f'Failed to write battery {x} ({metriclabel}) data to InfluxDB: {e}')
+
+                    dictB = decode_battery(reg_block, dictBatteryRatings[x-1])
+                    datapoint = to_line_protocol(metriclabel, dictB, now_ns)
+                    publish_metrics(dictB, 'battery', metriclabel, x, legacysupport, labeled)
+                    logger.debug('Battery %s: %s', metriclabel, dictB)
+                    logger.debug('Writing to Influx: %s', datapoint)
+                    points.append(datapoint)
 
                 else:
                     continue
-           
+
+            if write_queue.full():
+                logger.warning('InfluxDB write queue is full, dropping the oldest poll')
+                write_queue.get_nowait()
+            write_queue.put_nowait(points)
+
+            # Devices that missed discovery are retried now and then rather than dropped for good
+            if (None in dictMeterLabel or None in dictBattery) and time.monotonic() >= next_rediscovery:
+                next_rediscovery = time.monotonic() + _REDISCOVERY_INTERVAL
+                for x in range(1, mbmeters + 1):
+                    if dictMeterLabel[x-1] is None and await discover_meter(x):
+                        logger.info(f'Meter {x} answered discovery, polling it from now on')
+                for x in range(1, mbbatteries + 1):
+                    if dictBattery[x-1] is None and await discover_battery(x):
+                        logger.info(f'Battery {x} answered discovery, polling it from now on')
+                poll_meters, poll_batteries = poll_plan()
+
         # InfluxDBWriteError no longer exists; remove this except block
         except IOError as e:
             logger.error(f'I/O exception during operation: {e}')
@@ -788,6 +713,7 @@ if __name__ == '__main__':
     parser.add_argument('--prometheus_exporter_port', type=int, default=2112, help='Port on which the prometheus exporter will listen on')
     parser.add_argument('--interval', type=int, default=5, help='Time (seconds) between polling')
     parser.add_argument('--legacy_support', type=bool, default=False, help='Set to true so Meter 1 prometheus metrics start with "M_" vs "M1_"')
+    parser.add_argument('--labeled_metrics', action='store_true', help='Export Prometheus metrics as labeled solaredge_inverter/solaredge_meter/solaredge_battery families instead of one metric per field')
     parser.add_argument('inverter_ip', metavar='SolarEdge IP', help='IP address of the SolarEdge inverter to monitor')
     parser.add_argument('--debug', '-d', action='count')
     args = parser.parse_args()
@@ -804,8 +730,9 @@ if __name__ == '__main__':
     print(f'InfluxDB:\tServer: {args.influx_server}:{args.influx_port}\n\t\tDatabase: {args.influx_database}')
     print(f'Prometheus:\tExporter Port: {args.prometheus_exporter_port}\n')
     print(f'Legacy Support:\t{args.legacy_support}\n')
+    print(f'Labeled Metrics:\t{args.labeled_metrics}\n')
     logger.debug(f'Starting Prometheus exporter on port {args.prometheus_exporter_port}...')
     start_http_server(args.prometheus_exporter_port)
     #define_prometheus_metrics(args.meters)
     logger.debug('Running eventloop')
-    asyncio.run(write_to_influx(args.influx_server, args.influx_port, args.meters, args.batteries, args.interval, args.influx_database, args.legacy_support, args.influx_user, args.influx_pass))
+    asyncio.run(write_to_influx(args.inverter_ip, args.inverter_port, args.unitid, args.influx_server, args.influx_port, args.meters, args.batteries, args.interval, args.influx_database, args.legacy_support, args.influx_user, args.influx_pass, args.labeled_metrics))